@@ -1,19 +1,26 @@
 import os
 import hmac
-import hashlib
 import json
-import random
+import secrets
 import string
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from urllib.parse import unquote, parse_qs
+from urllib.parse import parse_qsl
 
+import httpx
+import redis
+from cachelib import SimpleCache
 from dotenv import load_dotenv
-from flask import Flask, abort, jsonify, render_template, request
+from flask import Flask, abort, g, jsonify, render_template, request
+from flask_caching import Cache
 from flask_cors import CORS
+from sqlalchemy.exc import IntegrityError, OperationalError
 from telegram import Bot, Update, ReplyKeyboardMarkup, WebAppInfo
 from telegram.ext import CallbackContext, CommandHandler, Dispatcher
 
-from models import db, Order, Product, User
+from models import db, Order, Product, User, ORDER_INDEX_DDL
 
 # --- App Initialization ---
 load_dotenv()
@@ -26,6 +33,11 @@ ADMIN_ID = int(os.getenv("ADMIN_ID"))
 SALES_GROUP_ID = os.getenv("SALES_GROUP_ID")
 COMMISSION_RATE = float(os.getenv("COMMISSION_RATE", 0.05))
 WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+REDIS_URL = os.getenv("REDIS_URL")
+BUFFERED_WRITES = os.getenv("BUFFERED_WRITES", "False") == "True"
+
+# initData secret key only depends on the bot token, so derive it once
+_TELEGRAM_SECRET_KEY = hmac.digest(b"WebAppData", TOKEN.encode(), "sha256")
 
 if DEV_MODE:
     app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('DATABASE_URL', 'sqlite:///local.db')
@@ -37,59 +49,307 @@ else:
 
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
-# --- Database & Bot Setup ---
+if REDIS_URL:
+    app.config['CACHE_TYPE'] = 'RedisCache'
+    app.config['CACHE_REDIS_URL'] = REDIS_URL
+elif DEV_MODE:
+    app.config['CACHE_TYPE'] = 'SimpleCache' # Per-process fallback for local development
+    if BUFFERED_WRITES:
+        raise ValueError("BUFFERED_WRITES requires REDIS_URL to be set")
+else:
+    # A per-process cache would leave other workers serving stale data after writes
+    raise ValueError("No REDIS_URL set for production environment")
+
+# --- Database, Cache & Bot Setup ---
 db.init_app(app)
+cache = Cache(app)
+redis_client = redis.from_url(REDIS_URL) if REDIS_URL else None
 bot = Bot(token=TOKEN)
+# Persistent HTTP/2 connection to the Bot API for outgoing messages
+tg_http = httpx.Client(http2=True, timeout=5.0, base_url=f"https://api.telegram.org/bot{TOKEN}")
 dispatcher = Dispatcher(bot, None, use_context=True)
+notify_executor = ThreadPoolExecutor(max_workers=4) # Keeps Telegram API calls off the request path
+webhook_executor = ThreadPoolExecutor(max_workers=8) # Processes bot updates after /webhook has answered
+
+# Columns sent to the Mini App; projecting them avoids building ORM instances
+PRODUCT_COLS = (Product.id, Product.name, Product.price, Product.quantity, Product.specs)
+ORDER_COLS = (
+    Order.id, Order.product_name, Order.product_price, Order.customer_name,
+    Order.customer_phone, Order.status, Order.commission_earned, Order.created_at
+)
+PRODUCTS_CACHE_KEY = 'products_all'
+PENDING_ORDERS_KEY = 'pending_orders'
+PROCESSING_ORDERS_KEY = 'pending_orders:processing' # Claimed by a flusher, not yet committed
+FAILED_ORDERS_KEY = 'pending_orders:failed' # Dead letters the flusher could not insert
+PROMO_CODES_KEY = 'promo_codes'
+ORDER_FLUSH_BATCH = 100
+ORDER_FLUSH_INTERVAL = 0.1 # seconds
+
+# Recently validated initData -> user dict; kept in-process since a Redis
+# round trip would cost more than the HMAC it saves
+_validated_init_data = SimpleCache(threshold=1000, default_timeout=30)
 
 # --- Helper Functions ---
 def validate_telegram_data(init_data: str) -> dict:
+    """Validates initData, reusing a recent successful validation of the same string."""
+    if not init_data:
+        return None
+    user = _validated_init_data.get(init_data)
+    if user is None:
+        user = _validate_telegram_data(init_data)
+        if user:
+            _validated_init_data.set(init_data, user)
+    return user
+
+def _validate_telegram_data(init_data: str) -> dict:
     """Validates initData from Telegram Mini App."""
     try:
-        encoded_data = parse_qs(init_data)
-        data_check_string = unquote(init_data)
+        pairs = parse_qsl(init_data, strict_parsing=True)
 
         # 1. Extract hash and sort data
-        received_hash = encoded_data['hash'][0]
-        data_check_string = '\n'.join(sorted([
-            f"{k}={encoded_data[k][0]}" for k in encoded_data if k != 'hash'
-        ]))
-
-        # 2. Calculate secret key and HMAC
-        secret_key = hmac.new("WebAppData".encode(), TOKEN.encode(), hashlib.sha256).digest()
-        calculated_hash = hmac.new(secret_key, data_check_string.encode(), hashlib.sha256).hexdigest()
-
-        # 3. Compare hashes
-        if calculated_hash == received_hash:
-            return json.loads(encoded_data['user'][0])
+        received_hash = None
+        fields = []
+        for k, v in pairs:
+            if k == 'hash':
+                received_hash = v
+            else:
+                fields.append(f"{k}={v}")
+        if received_hash is None:
+            return None
+        fields.sort()
+        data_check_string = '\n'.join(fields)
+
+        # 2. Calculate HMAC (one-shot OpenSSL path)
+        calculated_hash = hmac.digest(_TELEGRAM_SECRET_KEY, data_check_string.encode(), "sha256").hex()
+
+        # 3. Compare hashes (constant time)
+        if hmac.compare_digest(calculated_hash, received_hash):
+            return json.loads(next(v for k, v in pairs if k == 'user'))
         else:
             return None
     except Exception:
         return None
 
 def generate_promo_code(size=8, chars=string.ascii_uppercase + string.digits):
-    """Generates a unique promo code."""
+    """Generates a random promo code, reserving it in Redis (DB constraint stays authoritative)."""
+    if redis_client and not redis_client.exists(PROMO_CODES_KEY):
+        codes = [c for c, in db.session.query(User.promo_code).filter(User.promo_code.isnot(None))]
+        if codes:
+            redis_client.sadd(PROMO_CODES_KEY, *codes)
     while True:
-        code = ''.join(random.choice(chars) for _ in range(size))
-        if not User.query.filter_by(promo_code=code).first():
+        code = ''.join(secrets.choice(chars) for _ in range(size))
+        # SADD returns 0 if the code is already taken
+        if not redis_client or redis_client.sadd(PROMO_CODES_KEY, code):
             return code
 
+def _describe_bot_api_error(e: Exception) -> str:
+    """Describes a Bot API failure without the request URL, which embeds the token."""
+    if isinstance(e, httpx.HTTPStatusError):
+        try:
+            description = e.response.json().get('description')
+        except ValueError:
+            description = None
+        return f"HTTP {e.response.status_code}: {description}"
+    return str(e).replace(TOKEN, '<token>')
+
+def _send_message(recipient: str, **kwargs):
+    """Sends a Telegram message, logging instead of raising on failure."""
+    try:
+        tg_http.post('/sendMessage', json=kwargs).raise_for_status()
+    except Exception as e:
+        print(f"Error notifying {recipient}: {_describe_bot_api_error(e)}")
+
 def notify_admin(message: str):
-    """Sends a message to the admin."""
+    """Sends a message to the admin in the background."""
+    notify_executor.submit(_send_message, 'admin', chat_id=ADMIN_ID, text=message)
+
+def _notify_group(message: str):
+    """Sends a message to the sales group in the background."""
+    notify_executor.submit(_send_message, 'sales group', chat_id=SALES_GROUP_ID, text=message, parse_mode='HTML')
+
+if SALES_GROUP_ID:
+    notify_group = _notify_group
+else:
+    print("SALES_GROUP_ID not set. Group notifications are disabled.")
+    notify_group = lambda message: None
+
+@cache.memoize(timeout=60)
+def _leaderboard_current_month(month_key: str):
+    """Top 10 salespeople by completed sales for the given 'YYYY-MM' month."""
+    year, month = map(int, month_key.split('-'))
+    # Half-open range on created_at so the (status, created_at) index can be used
+    month_start = datetime(year, month, 1)
+    next_month = datetime(year + month // 12, month % 12 + 1, 1)
+    leaderboard = db.session.query(
+        User.first_name,
+        db.func.sum(Order.product_price).label('total_sales')
+    ).join(Order).filter(
+        Order.status == 'COMPLETED',
+        Order.created_at >= month_start,
+        Order.created_at < next_month
+    ).group_by(User.id).order_by(db.desc('total_sales')).limit(10).all()
+    return [{'name': name, 'sales': sales} for name, sales in leaderboard]
+
+def get_leaderboard():
+    """Returns the (cached) leaderboard for the current month."""
+    return _leaderboard_current_month(datetime.utcnow().strftime('%Y-%m'))
+
+def get_products():
+    """Returns the (cached) product catalog, ordered by name."""
+    products = cache.get(PRODUCTS_CACHE_KEY)
+    if products is None:
+        products = [dict(r._mapping) for r in db.session.query(*PRODUCT_COLS).order_by(Product.name).all()]
+        cache.set(PRODUCTS_CACHE_KEY, products, timeout=600)
+    return products
+
+def get_user_status(user_id: int):
+    """Returns a user's (status, first_name), cached for 5 minutes, or None if they don't exist."""
+    key = f"ustatus:{user_id}"
+    status = cache.get(key)
+    if status is None:
+        row = User.query.with_entities(User.status, User.first_name).filter_by(id=user_id).first()
+        if not row:
+            return None
+        status = (row.status, row.first_name)
+        cache.set(key, status, timeout=300)
+    return status
+
+def after_commit(func, *args):
+    """Schedules func(*args) to run once the current request has committed."""
+    g.setdefault('after_commit', []).append((func, args))
+
+def after_request_end(func, *args):
+    """Schedules func(*args) to run once the request has committed or rolled back."""
+    g.setdefault('after_request_end', []).append((func, args))
+
+def invalidate_leaderboard():
+    """Drops the cached leaderboard now and again when the request ends."""
+    cache.delete_memoized(_leaderboard_current_month)
+    after_request_end(cache.delete_memoized, _leaderboard_current_month)
+
+def invalidate_products():
+    """Drops the cached product catalog now and again when the request ends."""
+    cache.delete(PRODUCTS_CACHE_KEY)
+    after_request_end(cache.delete, PRODUCTS_CACHE_KEY)
+
+def invalidate_user_status(user_id: int):
+    """Drops a user's cached status now and again when the request ends."""
+    cache.delete(f"ustatus:{user_id}")
+    after_request_end(cache.delete, f"ustatus:{user_id}")
+
+def flush_buffered_orders():
+    """Background loop that bulk-inserts orders buffered in Redis by log_sale.
+
+    Entries are moved to PROCESSING_ORDERS_KEY while being inserted and only
+    removed from it after the insert has committed, so no failure (DB or Redis)
+    drops an accepted order, and no failure ends the loop.
+    """
+    claimed = []  # In the processing list, not yet inserted
+    inserted = []  # Committed, still to be removed from the processing list
     try:
-        bot.send_message(chat_id=ADMIN_ID, text=message)
+        leftover = redis_client.llen(PROCESSING_ORDERS_KEY)
+        if leftover:
+            # Not replayed automatically: another worker may be inserting them right now
+            print(f"{leftover} buffered orders left in {PROCESSING_ORDERS_KEY}; check them manually")
     except Exception as e:
-        print(f"Error notifying admin: {e}")
+        print(f"Error checking {PROCESSING_ORDERS_KEY}: {e}")
 
-def notify_group(message: str):
-    """Sends a message to the sales group."""
-    if not SALES_GROUP_ID:
-        print("SALES_GROUP_ID not set. Skipping group notification.")
-        return
+    while True:
+        try:
+            if inserted:
+                _release_orders(inserted)
+            if not claimed:
+                claimed.extend(_claim_orders())
+            if not claimed:
+                time.sleep(ORDER_FLUSH_INTERVAL)
+                continue
+            with app.app_context():
+                _insert_orders(claimed, inserted)
+        except Exception as e:
+            print(f"Error flushing buffered orders: {e}")
+            time.sleep(ORDER_FLUSH_INTERVAL)
+
+def _claim_orders():
+    """Moves up to ORDER_FLUSH_BATCH entries from the queue to the processing list."""
+    with redis_client.pipeline(transaction=False) as pipe:
+        for _ in range(ORDER_FLUSH_BATCH):
+            pipe.lmove(PENDING_ORDERS_KEY, PROCESSING_ORDERS_KEY, 'LEFT', 'RIGHT')
+        return [raw for raw in pipe.execute() if raw is not None]
+
+def _release_orders(inserted):
+    """Removes committed entries from the processing list."""
+    with redis_client.pipeline() as pipe:
+        for raw in inserted:
+            pipe.lrem(PROCESSING_ORDERS_KEY, 1, raw)
+        pipe.execute()
+    inserted.clear()
+
+def _order_from_buffer(raw) -> Order:
+    """Rebuilds an Order from an entry pushed by log_sale."""
+    order_data = json.loads(raw)
+    order_data['created_at'] = datetime.fromisoformat(order_data['created_at'])
+    return Order(**order_data)
+
+def _insert_orders(claimed, inserted):
+    """Inserts claimed entries, moving each from claimed to inserted once committed."""
     try:
-        bot.send_message(chat_id=SALES_GROUP_ID, text=message, parse_mode='HTML')
+        db.session.bulk_save_objects([_order_from_buffer(raw) for raw in claimed])
+        db.session.commit()
+    except OperationalError:
+        # Database unavailable: keep the batch claimed and retry after backing off
+        db.session.rollback()
+        raise
     except Exception as e:
-        print(f"Error notifying sales group: {e}")
+        # Some entry is bad: insert one by one so it can't hold up the rest
+        db.session.rollback()
+        print(f"Error flushing buffered orders, retrying individually: {e}")
+        _insert_orders_individually(claimed, inserted)
+    else:
+        inserted.extend(claimed)
+        claimed.clear()
+
+def _insert_orders_individually(claimed, inserted):
+    """Inserts claimed entries one at a time, dead-lettering the ones that fail."""
+    while claimed:
+        raw = claimed[0]
+        try:
+            db.session.add(_order_from_buffer(raw))
+            db.session.commit()
+        except OperationalError:
+            db.session.rollback()
+            raise
+        except Exception as e:
+            db.session.rollback()
+            with redis_client.pipeline() as pipe:
+                pipe.lrem(PROCESSING_ORDERS_KEY, 1, raw)
+                pipe.rpush(FAILED_ORDERS_KEY, raw)
+                pipe.execute()
+            print(f"Moved buffered order to {FAILED_ORDERS_KEY}: {e}")
+        else:
+            inserted.append(raw)
+        claimed.pop(0)
+
+# --- Request Lifecycle ---
+@app.after_request
+def commit_session(response):
+    """Commits the request's writes once, after the handler succeeded."""
+    succeeded = response.status_code < 400
+    try:
+        if succeeded:
+            db.session.commit()
+        else:
+            db.session.rollback()
+    finally:
+        # Cache drops run either way: the handler may have refilled a cache from
+        # autoflushed state that has now been committed or rolled back
+        for func, args in g.pop('after_request_end', ()):
+            func(*args)
+    # Side effects (notifications, queueing) only for committed work
+    hooks = g.pop('after_commit', ())
+    if succeeded:
+        for func, args in hooks:
+            func(*args)
+    return response
 
 # --- Telegram Command Handlers ---
 def start(update: Update, context: CallbackContext):
@@ -142,21 +402,11 @@ def init_user():
     }}
 
     if user.status == 'APPROVED':
-        response_data['products'] = [p.__dict__ for p in Product.query.order_by(Product.name).all()]
-        for p in response_data['products']: p.pop('_sa_instance_state', None)
+        response_data['products'] = get_products()
         
-        response_data['my_orders'] = [o.__dict__ for o in Order.query.filter_by(salesperson_id=user.id).order_by(Order.created_at.desc()).all()]
-        for o in response_data['my_orders']: o.pop('_sa_instance_state', None)
-
-        leaderboard = db.session.query(
-            User.first_name,
-            db.func.sum(Order.product_price).label('total_sales')
-        ).join(Order).filter(
-            Order.status == 'COMPLETED',
-            db.func.extract('month', Order.created_at) == datetime.utcnow().month,
-            db.func.extract('year', Order.created_at) == datetime.utcnow().year
-        ).group_by(User.id).order_by(db.desc('total_sales')).limit(10).all()
-        response_data['leaderboard'] = [{'name': name, 'sales': sales} for name, sales in leaderboard]
+        response_data['my_orders'] = [dict(r._mapping) for r in db.session.query(*ORDER_COLS).filter(Order.salesperson_id == user.id).order_by(Order.created_at.desc()).all()]
+
+        response_data['leaderboard'] = get_leaderboard()
 
     elif user.status == 'ADMIN':
         # Admins see everything
@@ -165,50 +415,45 @@ def init_user():
     return jsonify(response_data)
 
 # --- (Continuation of app.py) ---
-def get_admin_dashboard_data():
-    """Helper to fetch all data for the admin dashboard."""
-    # Approvals
-    pending_users = User.query.filter_by(status='PENDING').all()
-    # Orders
-    pending_orders_q = Order.query.filter_by(status='PENDING').options(db.joinedload(Order.salesperson)).order_by(Order.created_at.desc()).all()
-    pending_orders = []
-    for o in pending_orders_q:
-        order_dict = o.__dict__
-        order_dict.pop('_sa_instance_state', None)
-        order_dict['salesperson_name'] = o.salesperson.first_name
-        pending_orders.append(order_dict)
-    # Products
-    products = [p.__dict__ for p in Product.query.order_by(Product.name).all()]
-    for p in products: p.pop('_sa_instance_state', None)
-    # Payouts
-    salespeople = User.query.filter(User.status.in_(['APPROVED', 'ADMIN'])).all()
-    payouts = []
-    for s in salespeople:
-        total_sales = db.session.query(db.func.sum(Order.product_price)).filter_by(salesperson_id=s.id, status='COMPLETED').scalar() or 0
-        payouts.append({
-            'id': s.id,
-            'name': s.first_name,
-            'total_sales': total_sales,
-            'total_commission': total_sales * COMMISSION_RATE,
-            'unpaid_commission': s.unpaid_commission
-        })
-    # Leaderboard
-    leaderboard_q = db.session.query(
+def _pending_users():
+    """Users waiting for approval."""
+    return [{'id': u.id, 'first_name': u.first_name, 'username': u.username}
+            for u in User.query.filter_by(status='PENDING').all()]
+
+def _pending_orders():
+    """Orders waiting for approval, newest first."""
+    return [dict(r._mapping) for r in db.session.query(
+        *ORDER_COLS,
+        User.first_name.label('salesperson_name')
+    ).join(User, Order.salesperson_id == User.id).filter(Order.status == 'PENDING').order_by(Order.created_at.desc()).all()]
+
+def _payouts():
+    """Sales and commission totals per salesperson (one aggregated query)."""
+    salespeople = db.session.query(
+        User.id,
         User.first_name,
-        db.func.sum(Order.product_price).label('total_sales')
-    ).join(Order).filter(
-        Order.status == 'COMPLETED',
-        db.func.extract('month', Order.created_at) == datetime.utcnow().month,
-        db.func.extract('year', Order.created_at) == datetime.utcnow().year
-    ).group_by(User.id).order_by(db.desc('total_sales')).limit(10).all()
-    leaderboard = [{'name': name, 'sales': sales} for name, sales in leaderboard_q]
+        User.unpaid_commission,
+        db.func.coalesce(db.func.sum(Order.product_price), 0).label('total_sales')
+    ).outerjoin(Order, db.and_(
+        Order.salesperson_id == User.id,
+        Order.status == 'COMPLETED'
+    )).filter(User.status.in_(['APPROVED', 'ADMIN'])).group_by(User.id).all()
+    return [{
+        'id': s.id,
+        'name': s.first_name,
+        'total_sales': s.total_sales,
+        'total_commission': s.total_sales * COMMISSION_RATE,
+        'unpaid_commission': s.unpaid_commission
+    } for s in salespeople]
 
+def get_admin_dashboard_data():
+    """Helper to fetch all data for the admin dashboard."""
     return {
-        'pending_users': [{'id': u.id, 'first_name': u.first_name, 'username': u.username} for u in pending_users],
-        'pending_orders': pending_orders,
-        'products': products,
-        'payouts': payouts,
-        'leaderboard': leaderboard
+        'pending_users': _pending_users(),
+        'pending_orders': _pending_orders(),
+        'products': get_products(),
+        'payouts': _payouts(),
+        'leaderboard': get_leaderboard()
     }
 
 @app.route('/api/register', methods=['POST'])
@@ -223,7 +468,7 @@ def register_user():
     data = request.json
     user.phone_number = data.get('phone_number')
     user.first_name = data.get('first_name') # Allow updating name on registration
-    db.session.commit()
+    invalidate_user_status(user.id)
     return jsonify({'status': 'ok', 'user_status': user.status})
 
 @app.route('/api/sales', methods=['POST'])
@@ -232,35 +477,48 @@ def log_sale():
     tg_user_data = validate_telegram_data(init_data)
     if not tg_user_data: abort(403)
     
-    user = User.query.get(tg_user_data['id'])
-    if not user or user.status != 'APPROVED': abort(403)
+    user_id = tg_user_data['id']
+    status, first_name = get_user_status(user_id) or (None, None)
+    if status != 'APPROVED': abort(403)
 
     data = request.json
     product_id = data.get('productId')
+    if not data.get('customer_name') or not data.get('customer_phone'):
+        return jsonify({'error': 'Customer name and phone are required'}), 400
     
     if product_id == 'other':
         product_name = data.get('other_product_name')
+        if not product_name:
+            return jsonify({'error': 'Product name is required'}), 400
         product_price = float(data.get('other_product_price'))
     else:
-        product = Product.query.get(int(product_id))
-        if not product or product.quantity < 1:
+        # Atomic conditional decrement: no read-then-write race between salespeople
+        product = db.session.execute(
+            db.text("UPDATE product SET quantity = quantity - 1 WHERE id = :id AND quantity >= 1 RETURNING name, price"),
+            {'id': int(product_id)}
+        ).fetchone()
+        if not product:
             return jsonify({'error': 'Product out of stock or does not exist'}), 400
-        product.quantity -= 1
+        invalidate_products()
         product_name = product.name
         product_price = product.price
 
-    new_order = Order(
-        salesperson_id=user.id,
+    order_data = dict(
+        salesperson_id=user_id,
         product_name=product_name,
         product_price=product_price,
         customer_name=data.get('customer_name'),
         customer_phone=data.get('customer_phone'),
         commission_earned=product_price * COMMISSION_RATE
     )
-    db.session.add(new_order)
-    db.session.commit()
+    if BUFFERED_WRITES:
+        # Inserted in bulk by flush_buffered_orders shortly after
+        order_data['created_at'] = datetime.utcnow().isoformat()
+        after_commit(redis_client.rpush, PENDING_ORDERS_KEY, json.dumps(order_data))
+    else:
+        db.session.add(Order(**order_data))
     
-    notify_admin(f"New Sale Pending Approval:\n\nSalesperson: {user.first_name}\nProduct: {product_name}\nPrice: ${product_price:,.2f}\nCustomer: {data.get('customer_name')}")
+    after_commit(notify_admin, f"New Sale Pending Approval:\n\nSalesperson: {first_name}\nProduct: {product_name}\nPrice: ${product_price:,.2f}\nCustomer: {data.get('customer_name')}")
     
     return jsonify({'status': 'ok'}), 201
 
@@ -275,9 +533,18 @@ def approve_user(user_id):
     user_to_approve = User.query.get(user_id)
     if not user_to_approve or user_to_approve.status != 'PENDING': abort(404)
 
-    user_to_approve.status = 'APPROVED'
-    user_to_approve.promo_code = generate_promo_code()
-    db.session.commit()
+    # Rely on promo_code's unique constraint and retry on the (rare) collision
+    for _ in range(3):
+        user_to_approve.status = 'APPROVED'
+        user_to_approve.promo_code = generate_promo_code()
+        try:
+            db.session.commit()
+            break
+        except IntegrityError:
+            db.session.rollback()
+    else:
+        abort(500, 'Could not generate a unique promo code')
+    invalidate_user_status(user_id)
 
     # Notify the user
     welcome_message = (
@@ -285,7 +552,7 @@ def approve_user(user_id):
         f"Your unique promo code is: <b>{user_to_approve.promo_code}</b>\n\n"
         "You can now access your portal to log sales and track your performance. Good luck!"
     )
-    bot.send_message(chat_id=user_id, text=welcome_message, parse_mode='HTML')
+    notify_executor.submit(_send_message, 'approved user', chat_id=user_id, text=welcome_message, parse_mode='HTML')
 
     return jsonify(get_admin_dashboard_data())
 
@@ -304,6 +571,7 @@ def update_order(order_id):
         order.status = 'COMPLETED'
         # Add commission to salesperson's unpaid balance
         order.salesperson.unpaid_commission += order.commission_earned
+        invalidate_leaderboard()
         
         # Post celebration message to group chat
         group_message = (
@@ -313,18 +581,22 @@ def update_order(order_id):
             f"Price: ${order.product_price:,.2f}\n\n"
             f"Great job, keep it up! 🚀"
         )
-        notify_group(group_message)
+        after_commit(notify_group, group_message)
         
     elif action == 'reject':
+        if order.status == 'COMPLETED':
+            invalidate_leaderboard() # A completed sale drops out of the monthly totals
         order.status = 'CANCELLED'
         # If it was from inventory, restock it
-        product = Product.query.filter_by(name=order.product_name).first()
-        if product:
-            product.quantity += 1
+        restocked = db.session.execute(
+            db.text("UPDATE product SET quantity = quantity + 1 WHERE id = (SELECT min(id) FROM product WHERE name = :name)"),
+            {'name': order.product_name}
+        )
+        if restocked.rowcount:
+            invalidate_products()
     else:
         abort(400, 'Invalid action')
         
-    db.session.commit()
     return jsonify(get_admin_dashboard_data())
 
 
@@ -343,14 +615,14 @@ def manage_product():
             specs=data['specs']
         )
         db.session.add(new_product)
-        db.session.commit()
+        invalidate_products()
     
     elif request.method == 'DELETE':
         product_id = request.args.get('id')
         product_to_delete = Product.query.get(product_id)
         if not product_to_delete: abort(404)
         db.session.delete(product_to_delete)
-        db.session.commit()
+        invalidate_products()
 
     return jsonify(get_admin_dashboard_data())
 
@@ -365,7 +637,6 @@ def mark_paid(user_id):
     if not salesperson: abort(404)
     
     salesperson.unpaid_commission = 0.0
-    db.session.commit()
 
     return jsonify(get_admin_dashboard_data())
 
@@ -376,9 +647,17 @@ def mark_paid(user_id):
 def webhook():
     """Webhook endpoint to receive updates from Telegram."""
     update = Update.de_json(request.get_json(force=True), bot)
-    dispatcher.process_update(update)
+    webhook_executor.submit(_process_update_with_ctx, update)
     return 'ok'
 
+def _process_update_with_ctx(update: Update):
+    """Runs a Telegram update through the dispatcher inside an app context."""
+    with app.app_context():
+        try:
+            dispatcher.process_update(update)
+        except Exception as e:
+            print(f"Error processing update: {e}")
+
 @app.route('/set_webhook', methods=['GET'])
 def set_webhook():
     """A one-time route to set the webhook."""
@@ -388,7 +667,13 @@ def set_webhook():
     # We append '/webhook' to the base URL
     webhook_full_url = f"{WEBHOOK_URL.rstrip('/')}/webhook"
     
-    success = bot.set_webhook(webhook_full_url)
+    try:
+        response = tg_http.post('/setWebhook', json={'url': webhook_full_url})
+        response.raise_for_status()
+        success = response.json().get('ok')
+    except Exception as e:
+        print(f"Error setting webhook: {_describe_bot_api_error(e)}")
+        success = False
     if success:
         return f"Webhook set to {webhook_full_url}"
     else:
@@ -396,9 +681,19 @@ def set_webhook():
 
 dispatcher.add_handler(CommandHandler('start', start))
 
+if BUFFERED_WRITES:
+    threading.Thread(target=flush_buffered_orders, daemon=True).start()
+
+def ensure_indexes():
+    """Creates Order's indexes on databases whose tables predate them."""
+    for ddl in ORDER_INDEX_DDL:
+        db.session.execute(db.text(ddl))
+    db.session.commit()
+
 if __name__ == '__main__':
     with app.app_context():
         db.create_all()
+        ensure_indexes()
         # Create admin user if it doesn't exist
         if not User.query.get(ADMIN_ID):
             admin_user = User(id=ADMIN_ID, first_name="Admin", status='ADMIN', promo_code='ADMIN')
@@ -31,4 +31,15 @@ class Order(db.Model):
     customer_phone = db.Column(db.String(20), nullable=False)
     status = db.Column(db.String(20), default='PENDING', nullable=False) # PENDING, COMPLETED, CANCELLED
     commission_earned = db.Column(db.Float, nullable=False)
-    created_at = db.Column(DateTime, default=datetime.utcnow)
\ No newline at end of file
+    created_at = db.Column(DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.Index('ix_order_status_created', 'status', 'created_at'),
+        db.Index('ix_order_salesperson_created', 'salesperson_id', 'created_at'),
+    )
+
+# db.create_all() doesn't add indexes to existing tables; this DDL is idempotent
+ORDER_INDEX_DDL = (
+    'CREATE INDEX IF NOT EXISTS ix_order_status_created ON "order" (status, created_at)',
+    'CREATE INDEX IF NOT EXISTS ix_order_salesperson_created ON "order" (salesperson_id, created_at)',
+)